@@ -3,49 +3,112 @@
 For more info: https://github.com/aserpi/rclone-sync
 """
 import argparse
+import array
 import atexit
-import dataclasses
-import datetime
+import calendar
+import concurrent.futures
+import csv
+import fcntl
+import functools
 import hashlib
+import io
+import os
 import pathlib
-import re
 import subprocess
 import sys
 import tempfile
-from typing import Any, Dict, List, Optional, Set, Tuple, Union  # TODO: PEP 585
+import threading
+import time
+from typing import (  # TODO: PEP 585
+    AbstractSet, Any, Dict, FrozenSet, Iterable, List, Optional, Tuple, Union)
 
 __version__ = "0.0.1"
 
 PathLike = Union[pathlib.Path, str]
+RCLONE_DIR_NOT_FOUND = 3  # rclone exit code
 RCLONE_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+_TYPE_IDX = {"db_1": 0, "db_2": 1, "path_1": 2, "path_2": 3}
+_RECORD_SIZE = 2 * len(_TYPE_IDX)
+_EMPTY_RECORD = array.array("q", [-1] * _RECORD_SIZE)
 
-@dataclasses.dataclass
-class FileAttributes:
-    size: Optional[int] = None
-    timestamp = datetime.datetime.min
 
+class FileTable:
+    """Properties of the files, stored as packed records.
 
-class SyncFile:
-    _types = {"db_1", "db_2", "path_1", "path_2"}
+    Each file is a row, identified by its path. A row is a record of
+    _RECORD_SIZE 64-bit integers in a single array: first the sizes,
+    then the timestamps (in seconds, see parse_timestamp), each indexed
+    by _TYPE_IDX. A size of -1 means that the file is missing.
+    """
+    __slots__ = ("index", "paths", "records")
 
-    def __init__(self, path):
-        self.path = path
-        self.db_1 = FileAttributes()
-        self.db_2 = FileAttributes()
-        self.path_1 = FileAttributes()
-        self.path_2 = FileAttributes()
+    def __init__(self) -> None:
+        self.index: Dict[str, int] = {}
+        self.paths: List[str] = []
+        self.records: "array.array[int]" = array.array("q")
 
-    def add_properties(self, type_: str, size: str, timestamp: str) -> None:
-        assert type_ in SyncFile._types
-        file_attrs = self.__getattribute__(type_)
-        file_attrs.size = int(size)
-        file_attrs.timestamp = datetime.datetime.strptime(timestamp, RCLONE_TIMESTAMP_FORMAT)
+    def __len__(self) -> int:
+        return len(self.paths)
 
-    def stringify_properties(self, type_: str) -> str:
-        timestamp = self.__getattribute__(f"{type_}_timestamp")
-        size = self.__getattribute__(f"{type_}_size")
-        return f"{self.path};{timestamp};{size}"
+    def merge(self, other: "FileTable", type_: str) -> None:
+        """Copies the properties of a type from another table."""
+        sizes = other.sizes(type_)
+        timestamps = other.timestamps(type_)
+        for row, path in enumerate(other.paths):
+            self.set_properties(path, type_, sizes[row], timestamps[row])
+
+    def offset(self, path: str) -> int:
+        """Returns the offset of the record of a file, adding it if needed."""
+        try:
+            return self.index[path] * _RECORD_SIZE  # File already encountered somewhere
+        except KeyError:  # First time we see the file
+            offset = len(self.records)
+            self.index[path] = len(self.paths)
+            self.paths.append(path)
+            self.records.extend(_EMPTY_RECORD)
+            return offset
+
+    def set_properties(self, path: str, type_: str, size: int, timestamp: int) -> None:
+        type_idx = _TYPE_IDX[type_]
+        offset = self.offset(path)
+        self.records[offset + type_idx] = size
+        self.records[offset + len(_TYPE_IDX) + type_idx] = timestamp
+
+    def sizes(self, type_: str) -> "array.array[int]":
+        """Returns the column of the sizes of a type."""
+        return self.records[_TYPE_IDX[type_]::_RECORD_SIZE]
+
+    def stringify_properties(self, path: str, type_: str) -> str:
+        type_idx = _TYPE_IDX[type_]
+        offset = self.index[path] * _RECORD_SIZE
+        timestamp = time.strftime(
+            RCLONE_TIMESTAMP_FORMAT,
+            time.gmtime(self.records[offset + len(_TYPE_IDX) + type_idx]))
+        return f"{path};{timestamp};{self.records[offset + type_idx]}"
+
+    def timestamps(self, type_: str) -> "array.array[int]":
+        """Returns the column of the timestamps of a type."""
+        return self.records[len(_TYPE_IDX) + _TYPE_IDX[type_]::_RECORD_SIZE]
+
+
+class LsfProcesses:
+    """Running `rclone lsf` processes, which can be cancelled together."""
+    __slots__ = ("cancelled", "processes")
+
+    def __init__(self) -> None:
+        self.cancelled = threading.Event()
+        self.processes: List[subprocess.Popen] = []
+
+    def add(self, proc: subprocess.Popen) -> None:
+        self.processes.append(proc)
+        if self.cancelled.is_set():  # Cancelled before proc was added
+            proc.kill()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+        for proc in list(self.processes):
+            proc.kill()
 
 
 def check_rclone_config(rclone_path: PathLike = "rclone",
@@ -77,11 +140,6 @@ def check_rclone_config(rclone_path: PathLike = "rclone",
         sys.exit(11)
 
 
-def delete_lock_file(lock_file: pathlib.Path) -> None:
-    """Deletes the lock file."""
-    lock_file.unlink()
-
-
 def get_paths_id(path_1: str, path_2: str) -> str:
     """Returns a deterministic (nearly-)unique id for the paths.
 
@@ -89,11 +147,12 @@ def get_paths_id(path_1: str, path_2: str) -> str:
     unique identifier but, since its size is not constrained a priori,
     it cannot be used as a file name.
 
-    The hexadecimal SHA-256 hash digest of the concatenation of the two
-    paths is guaranteed to be collision resistant, therefore it can
-    be used as an id.
+    The hexadecimal BLAKE2b (256-bit) hash digest of the concatenation
+    of the two paths is guaranteed to be collision resistant, therefore
+    it can be used as an id. BLAKE2b is preferred over SHA-256 because
+    it is considerably faster on CPUs without SHA extensions.
     """
-    paths_hash = hashlib.sha256()
+    paths_hash = hashlib.blake2b(digest_size=32)
     paths_hash.update(path_1.encode())
     paths_hash.update(path_2.encode())
 
@@ -105,9 +164,16 @@ def list_files(path_1: PathLike,  # pylint: disable=too-many-arguments
                paths_id: str,
                working_dir: pathlib.Path = pathlib.Path("~/.rclone-sync"),
                retries: int = 1,
+               checkers: Optional[int] = None,
                rclone_path: PathLike = "rclone",
-               rclone_config: Optional[PathLike] = None) -> Dict[str, SyncFile]:  # yapf: disable
-    """TODO: documentation"""
+               rclone_config: Optional[PathLike] = None) -> FileTable:  # yapf: disable
+    """TODO: documentation
+
+    Remote paths (i.e., str as returned by resolve_path) are listed with
+    `--fast-list`, which needs fewer API calls at the cost of rclone
+    buffering the listing in memory: this is fine, since the whole
+    listing is needed anyway.
+    """
     working_dir = working_dir.expanduser().resolve(strict=False)
     try:
         working_dir.mkdir(exist_ok=True, parents=True)
@@ -115,22 +181,25 @@ def list_files(path_1: PathLike,  # pylint: disable=too-many-arguments
         print(f"Cannot use the working directory: got {e.strerror} on {e.filename}")
         sys.exit(24)
 
-    files: Dict[str, SyncFile] = {}
     args = [str(rclone_path), "lsf", "-R", "--files-only", "--format", "pts"]
     if rclone_config:
         args.append("--config")
         args.append(str(rclone_config))
-    args.append(str(path_1))
-
-    list_files_in_path(args, 1, files, retries)
-    args.pop()
-    args.append(str(path_2))
-    list_files_in_path(args, 2, files, retries)
-    args.pop()
+    if checkers:
+        args.append("--checkers")
+        args.append(str(checkers))
+    args_1 = [*args, "--fast-list", path_1] if isinstance(path_1, str) else [*args, str(path_1)]
+    args_2 = [*args, "--fast-list", path_2] if isinstance(path_2, str) else [*args, str(path_2)]
+
+    # Both paths are always listed recursively: a shallow listing cannot
+    # prove that nothing changed, since most backends do not propagate
+    # modification times to parent directories (and some have no
+    # directories at all).
+    files = list_files_in_paths(args_1, args_2, retries)
 
     try:
-        with open(working_dir / f"{paths_id}_1", "r") as lsf_file_1:
-            parse_lsf(lsf_file_1.read(), "lsf_1", files)
+        with open(working_dir / f"{paths_id}_1", "r", encoding="utf-8", newline="") as lsf_file_1:
+            parse_lsf(lsf_file_1, "db_1", files)
     except FileNotFoundError:
         print("No previous-sync file for path_1: creating one.")
         (working_dir / f"{paths_id}_1").touch()
@@ -138,11 +207,11 @@ def list_files(path_1: PathLike,  # pylint: disable=too-many-arguments
         print(f"Cannot read the previous-sync file for path_1: got {e.strerror} on {e.filename}")
         sys.exit(21)
     try:
-        with open(working_dir / f"{paths_id}_2", "r") as lsf_file_2:
-            parse_lsf(lsf_file_2.read(), "db_2", files)
+        with open(working_dir / f"{paths_id}_2", "r", encoding="utf-8", newline="") as lsf_file_2:
+            parse_lsf(lsf_file_2, "db_2", files)
     except FileNotFoundError:
         print("No previous-sync file for path_2: creating one.")
-        (working_dir / f"db_2").touch()
+        (working_dir / f"{paths_id}_2").touch()
     except OSError as e:
         print(f"Cannot read the previous-sync file for path_2: got {e.strerror} on {e.filename}")
         sys.exit(22)
@@ -152,67 +221,166 @@ def list_files(path_1: PathLike,  # pylint: disable=too-many-arguments
 
 def list_files_in_path(args: List[str],
                        path_number: int,
-                       files: Dict[str, SyncFile],
-                       retries: int = 1) -> bool:
+                       retries: int = 1,
+                       processes: Optional[LsfProcesses] = None) -> FileTable:
     """Retrieves file properties from a path.
 
+    The output of rclone is parsed while it is being produced, so that
+    the whole listing is never held in memory.
+
     Args:
         args: command-line arguments
         path_number: path number
-        files: dictionary in which insert the parsed files
         retries: max number of retries
+        processes: group in which register the rclone process; if the
+            group is cancelled, no more retries are attempted
+
+    Returns:
+        A new table with the files in the path.
     """
+    type_ = f"path_{path_number}"
     for i in range(retries):
-        ret = subprocess.run(args, capture_output=True, check=False, text=True)
+        files = FileTable()
+        # File descriptors opened by Python are not inheritable (PEP 446),
+        # so there is no need to close them all in the child.
+        with tempfile.TemporaryFile() as stderr, \
+                subprocess.Popen(args, bufsize=1 << 20, stdout=subprocess.PIPE, stderr=stderr,
+                                 close_fds=False) as proc:
+            assert proc.stdout is not None  # stdout=subprocess.PIPE
+            if processes:
+                processes.add(proc)
+            # rclone always outputs UTF-8: decode it explicitly instead of
+            # relying on the locale, and leave newlines to the csv module.
+            parse_lsf(io.TextIOWrapper(proc.stdout, encoding="utf-8", newline=""), type_, files)
+            returncode = proc.wait()
+
+            if processes and processes.cancelled.is_set():  # Killed, the error is elsewhere
+                sys.exit(3 + path_number)
+            if not returncode:
+                return files
+            # A missing root directory is a remote one that has not been created yet,
+            # but rclone also returns this code if a directory vanishes mid-listing.
+            if returncode == RCLONE_DIR_NOT_FOUND and not files:
+                return files
+
+            stderr.seek(0)
+            print(f"Failed to list files in path_{path_number} ({i + 1}/{retries}): "
+                  f"{stderr.read().decode(errors='replace')}")
+    sys.exit(3 + path_number)
 
-        if not ret.returncode:
-            parse_lsf(ret.stdout, f"path_{path_number}", files)
-            return True
 
-        print(f"Failed to list files in path_{path_number} ({i + 1}/{retries}): {ret.stderr}")
-    sys.exit(3 + path_number)
+def list_files_in_paths(args_1: List[str], args_2: List[str], retries: int = 1) -> FileTable:
+    """Retrieves file properties from both paths concurrently.
+
+    Listing is usually network-bound, so the two paths are listed at
+    the same time. If a listing fails, the other one is killed instead
+    of waiting for it.
 
+    Args:
+        args_1: command-line arguments for path_1
+        args_2: command-line arguments for path_2
+        retries: max number of retries for each path
+
+    Returns:
+        A new table with the files in both paths.
+    """
+    processes = LsfProcesses()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        future_1 = executor.submit(list_files_in_path, args_1, 1, retries, processes)
+        future_2 = executor.submit(list_files_in_path, args_2, 2, retries, processes)
+        done, _ = concurrent.futures.wait((future_1, future_2),
+                                          return_when=concurrent.futures.FIRST_EXCEPTION)
+        failed = [future for future in done if future.exception()]
+        if failed:
+            processes.cancel()
+    if failed:
+        failed[0].result()  # Re-raises the error
+
+    files = future_1.result()
+    files.merge(future_2.result(), "path_2")
+    return files
 
+
+@functools.lru_cache(maxsize=4)
 def list_remotes(rclone_path: PathLike = "rclone",
-                 rclone_config: Optional[PathLike] = None) -> Set[str]:
-    """Lists the remotes configured in rclone."""
+                 rclone_config: Optional[PathLike] = None) -> FrozenSet[str]:
+    """Lists the remotes configured in rclone.
+
+    Results are cached, so rclone is run only once per configuration.
+    """
     args = [rclone_path, "listremotes"]
     if rclone_config is not None:
         args.append("--config")
         args.append(rclone_config)
 
-    return set(
-        re.findall(r"(\S+):",
-                   subprocess.run(args, capture_output=True, check=False, text=True).stdout))
+    stdout = subprocess.run(args, capture_output=True, check=False).stdout.decode()
+    return frozenset(line[:-1] for line in stdout.splitlines() if line.endswith(":"))
 
 
-def parse_lsf(lsf_output: str, type_: str, files: Dict[str, SyncFile]) -> None:
-    """Parses the output of `rclone lsf`.
+def normalise_path(path: PathLike) -> str:
+    """Normalises a path without resolving it.
 
-    Args:
-        lsf_output: the output of a `rclone lsf --files-only --format pts` run.
-        type_: the type of path ('path_1', 'path_2', 'lsf_1' or 'lsf_2').
-        files: dictionary in which insert the parsed files.
+    Only '~' is expanded and trailing slashes are removed (but a root
+    slash is kept: 'remote:/' differs from 'remote:' for some backends).
+    Components such as '..' are left alone, since collapsing them
+    without resolving symlinks could make different paths look equal.
     """
-    for f in lsf_output.rstrip().split("\n"):
-        f_split = f.rsplit(";", 2)  # Filename may contain semicolons
+    path = str(path)
+    remote, colon, remote_path = path.partition(":")
+    # Same rules as resolve_path
+    if not colon or "/" in remote:  # local path
+        path = os.path.expanduser(path)
+        return path.rstrip("/") or path[:1]
+    return f"{remote}:{remote_path.rstrip('/') or remote_path[:1]}"
 
-        try:
-            f_obj = files[f_split[0]]  # File already encountered somewhere
-        except KeyError:  # First time we see the file
-            f_obj = SyncFile(f_split[0])
-            files[f_split[0]] = f_obj
 
-        f_obj.add_properties(type_, f_split[2], f_split[1])
+def parse_lsf(lsf_output: Iterable[str], type_: str, files: FileTable) -> None:
+    """Parses the output of `rclone lsf`.
+
+    Args:
+        lsf_output: the lines of a `rclone lsf --files-only --format pts` run.
+        type_: the type of path ('path_1', 'path_2', 'db_1' or 'db_2').
+        files: table in which insert the parsed files.
+    """
+    # Hot loop: resolve the record positions once, then write to the records directly.
+    size_idx = _TYPE_IDX[type_]
+    timestamp_idx = len(_TYPE_IDX) + size_idx
+    offset = files.offset
+    records = files.records
+    for fields in csv.reader(lsf_output, delimiter=";", quoting=csv.QUOTE_NONE):
+        if not fields:  # Empty line
+            continue
+        # Filename may contain semicolons
+        record = offset(fields[0] if len(fields) == 3 else ";".join(fields[:-2]))
+        records[record + size_idx] = int(fields[-1])
+        records[record + timestamp_idx] = parse_timestamp(fields[-2])
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def parse_timestamp(timestamp: str) -> int:
+    """Parses a timestamp in RCLONE_TIMESTAMP_FORMAT.
+
+    The timestamp is converted to seconds since the epoch as if it were
+    in UTC, so that it can be formatted back with time.gmtime.
+
+    The format is fixed, hence slicing is much faster than strptime.
+    Recent results are cached, since many files usually share the same
+    modification time; the cache is bounded to keep memory usage flat
+    on large listings.
+    """
+    return calendar.timegm((int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                            int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19])))
 
 
 # TODO (aserpi): add Windows support
 def resolve_path(path: PathLike,
-                 remotes: Union[List[str], Set[str]],
-                 rclone_path: PathLike = "rclone",
-                 rclone_config: Optional[PathLike] = None) -> Optional[PathLike]:
+                 remotes: Union[List[str], AbstractSet[str]]) -> Optional[PathLike]:
     """Resolves the path.
 
+    Local directories are created if missing. Remote directories are
+    not: rclone creates them when the first file is copied, and a
+    missing directory is listed as empty (see list_files_in_path).
+
     Returns:
         None if the path cannot be used by rclone.
         A pathlib.Path object for an absolute path if the path is local.
@@ -231,14 +399,6 @@ def resolve_path(path: PathLike,
             if "/" in path_split[0]:
                 path = pathlib.Path(path)  # local path, process in other isinstance branch
             elif path_split[0] in remotes:  # remote path
-                args = [rclone_path, "mkdir", path]
-                if rclone_config:
-                    args.append("--config")
-                    args.append(rclone_config)
-                ret = subprocess.run(args, capture_output=True, check=False, text=True)
-                if ret.returncode:
-                    print(ret.stderr)
-                    return None
                 return path
             else:  # Also handles the case where path is ":"
                 print(f"Remote '{path_split[0]}' was not found")
@@ -261,20 +421,24 @@ def resolve_paths(
         path_1: PathLike,
         path_2: PathLike,
         rclone_path: PathLike = "rclone",
-        rclone_config: Optional[PathLike] = None) -> Tuple[Optional[PathLike], Optional[PathLike]]:
+        rclone_config: Optional[PathLike] = None) -> Tuple[PathLike, PathLike]:
     """Resolves the two paths.
 
+    Exits if a path is invalid or if the paths are identical.
+
     Returns:
-        See resolve_path. In addition, it returns (None, None) if the
-        paths are identical.
+        See resolve_path.
     """
+    # Catch identical paths before spawning rclone to resolve them.
+    if path_1 and path_2 and normalise_path(path_1) == normalise_path(path_2):
+        print("The two paths are identical!")
+        sys.exit(3)
+
     remotes = list_remotes(rclone_path=rclone_path, rclone_config=rclone_config)
-    if not (absolute_path_1 := resolve_path(
-            path_1, remotes, rclone_path=rclone_path, rclone_config=rclone_config)):
+    if not (absolute_path_1 := resolve_path(path_1, remotes)):
         sys.exit(1)
 
-    if not (absolute_path_2 := resolve_path(
-            path_2, remotes, rclone_path=rclone_path, rclone_config=rclone_config)):
+    if not (absolute_path_2 := resolve_path(path_2, remotes)):
         sys.exit(2)
 
     if absolute_path_1 == absolute_path_2:
@@ -293,6 +457,7 @@ def main() -> None:
     parser.add_argument("path_2", help="second path")
 
     # Optional arguments
+    parser.add_argument("--checkers", help="number of checkers to run in parallel", type=int)
     parser.add_argument("-r", "--rclone", help="rclone executable file", type=pathlib.Path)
     parser.add_argument("--retries", help="number of retries", type=int)
     parser.add_argument("--rclone-config", help="rclone configuration file", type=pathlib.Path)
@@ -312,27 +477,30 @@ def main() -> None:
 
     # Since path order is important, using always the same (for
     # different runs) greatly simplifies application logic.
-    path_1_str = str(path_1)
-    path_2_str = str(path_2)
-    if path_1_str > path_2_str:
-        path_1, path_2 = path_2, path_1
-        path_1_str, path_2_str = path_2_str, path_1_str
-    paths_id = get_paths_id(path_1_str, path_2_str)
+    path_1, path_2 = sorted((path_1, path_2), key=str)
+    paths_id = get_paths_id(str(path_1), str(path_2))
 
     # Use a lock file to avoid simultaneous identical runs.
-    locks_dir = pathlib.Path(tempfile.gettempdir()) / "rclone-sync"
-    locks_dir.mkdir(exist_ok=True)
-    lock_file = locks_dir / paths_id
+    locks_dir = os.path.join(tempfile.gettempdir(), "rclone-sync")
+    os.makedirs(locks_dir, exist_ok=True)
+    # The lock is released by the OS when the process ends, even abnormally.
+    lock_file = os.path.join(locks_dir, paths_id)
+    try:
+        lock_fd = os.open(lock_file, os.O_CREAT | os.O_RDWR, 0o644)
+    except OSError as e:
+        print(f"Cannot use the lock file '{lock_file}': got '{e.strerror}'")
+        sys.exit(25)
     try:
-        lock_file.touch(exist_ok=False)
-    except FileExistsError:
-        print(f"rclone-sync is already synchronising the two paths.\n"
-              f"If it is not the case, delete the file '{lock_file}'.")
+        fcntl.lockf(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (BlockingIOError, PermissionError):
+        print("rclone-sync is already synchronising the two paths.")
         sys.exit(23)
-    atexit.register(delete_lock_file, lock_file)
+    atexit.register(os.close, lock_fd)
 
     if args.retries:
         other_args["retries"] = args.retries
+    if args.checkers:
+        other_args["checkers"] = args.checkers
     if args.working_directory:
         other_args["working_dir"] = args.working_directory
     files = list_files(path_1, path_2, paths_id, **other_args)